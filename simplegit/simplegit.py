@@ -9,40 +9,64 @@
 #
 
 
-import filecmp
 import os
 import sys
-import uuid
-from distutils.dir_util import copy_tree
-from os.path import exists, isdir, normpath, join, dirname, relpath, basename
-from shutil import copy2
+import time
+from os.path import normpath, join, dirname, relpath, basename
+from stat import S_ISDIR
 
 REPO_DIR = ".simplegit"
 
 # files in 'REPO_DIR':
 HEAD = 'HEAD'  # file that remembers last commit in actual state
 TO_COMMIT = 'TO_COMMIT'  # tracked files list
+STATUS_CACHE = 'STATUS_CACHE'  # last 'status' output with its validity keys
 
 # in each commit directory (named with commit hash) there are following files:
 TRACKED_LIST = 'TRACKED_LIST'  # list of all files tracked by this commit
 PREV_COMMIT = 'PREV_COMMIT'  # keeps hash of previous commit, empty if none
 COMMIT_DIR = 'COMMIT_DIR'  # directory containing all commit-files
 
+# HEAD value of each repository, read at most once per invocation
+_HEAD_CACHE = {}
 
-def allFiles(path):
-    """Given !absolute path returns list of absolute paths
+# directories modified that recently (in ns) before a scan are not cached,
+# as further changes within the same mtime tick would go unnoticed
+STATUS_CACHE_RACY_NS = 2 * 10**9
+
+
+def allFiles(path, dirMtimes=None):
+    """Given path yields paths (joined with 'path')
     of all visible, non-directory files in 'path' location.
-    For usage with relative path, i.e. '.' <if not f[0] == '.'>
-    needst to be changed not to throw out proper '.' dir.
+    Only entry names are checked for being hidden, so 'path' itself
+    may be relative, i.e. '.'.
+    If 'dirMtimes' dict is given, it's filled with st_mtime_ns
+    of every visited directory, 'path' included. Entries whose listing
+    doesn't depend on directory mtimes only (unreadable directories,
+    symlinks) are put there with None.
     """
-    retFiles = []
-    for root, dirs, files in os.walk(path):
-        # ignore hidden files
-        files = [f for f in files if not f[0] == '.']
-        dirs[:] = [d for d in dirs if not d[0] == '.']
-        for file in files:
-            retFiles.append(normpath(join(root, file)))
-    return retFiles
+    try:
+        if dirMtimes is not None:
+            dirMtimes[path] = os.stat(path).st_mtime_ns
+        entries = os.scandir(path)
+    except OSError:
+        # skip unreadable directories, as os.walk does
+        if dirMtimes is not None:
+            dirMtimes[path] = None
+        return
+    with entries:
+        for entry in entries:
+            # ignore hidden files; checked before is_dir(), so hidden
+            # directories ('REPO_DIR' included) are pruned unvisited
+            if entry.name[0] == '.':
+                continue
+            if dirMtimes is not None and entry.is_symlink():
+                # listed or not depending on its target
+                dirMtimes[entry.path] = None
+            if entry.is_dir(follow_symlinks=False):
+                yield from allFiles(entry.path, dirMtimes)
+            elif entry.is_file():
+                yield entry.path
 
 
 def fatalError(msg):
@@ -53,10 +77,30 @@ def fatalError(msg):
 
 def changePathsRef(initAbsolutePath, destAbsolutePath, files):
     """Given init absolute path and list of file paths, relative to init path
-    it returns that list, but with paths now relating to 'destAbsolutePath'.
+    it yields these paths, but now relating to 'destAbsolutePath'.
     """
-    fileAbsolutePaths = [normpath(join(initAbsolutePath, f)) for f in files]
-    return [relpath(f, destAbsolutePath) for f in fileAbsolutePaths]
+    # paths inside 'destAbsolutePath' only need their prefix stripped
+    destPrefix = join(destAbsolutePath, '')
+    for f in files:
+        f = join(initAbsolutePath, f)
+        # 'initAbsolutePath' is normalized, so normpath() is only needed
+        # when 'f' brought '.'/'..' components, doubled or trailing slashes
+        if '/.' in f or '//' in f or f.endswith('/'):
+            f = normpath(f)
+        if f.startswith(destPrefix) and f != destAbsolutePath:
+            yield f[len(destPrefix):]
+        else:
+            yield relpath(f, destAbsolutePath)
+
+
+def statOrNone(path):
+    """Returns os.stat() result for 'path' or None if it can't be stat'ed,
+    so existence and file type are known from a single syscall.
+    """
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
 
 
 def nearestRepo(absolutePath):
@@ -66,136 +110,275 @@ def nearestRepo(absolutePath):
     """
     tmpPath = normpath(absolutePath)
     while tmpPath:
-        possibleRepo = normpath(join(tmpPath, REPO_DIR))
-        if exists(possibleRepo) and isdir(possibleRepo):
-            return dirname(possibleRepo)
+        # single stat instead of exists() + isdir()
+        st = statOrNone(join(tmpPath, REPO_DIR))
+        if st is not None and S_ISDIR(st.st_mode):
+            return tmpPath
         if tmpPath == '/':
             return None
         tmpPath = dirname(tmpPath)
     return None
 
 
+def readLines(path):
+    """Returns lines of (small) file under 'path', read with a single
+    unbuffered read() to avoid buffered-IO setup syscalls.
+    Repository files are UTF-8, with undecodable file name bytes
+    kept as surrogates, as they come from os.scandir().
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.read(fd, os.fstat(fd).st_size)
+        return data.decode('utf-8', 'surrogateescape').splitlines()
+    finally:
+        os.close(fd)
+
+
 def lastCommitHash(repoPath):
-    with open(normpath(join(repoPath, REPO_DIR, HEAD)), 'r') as headFile:
-        return headFile.readline().strip()
+    commitHash = _HEAD_CACHE.get(repoPath)
+    if commitHash is None:
+        lines = readLines(join(repoPath, REPO_DIR, HEAD))
+        commitHash = lines[0].strip() if lines else ''
+        _HEAD_CACHE[repoPath] = commitHash
+    return commitHash
 
 
 def init(path):
-    path = normpath(join(path, REPO_DIR))
-    if not os.path.exists(path):
+    path = join(path, REPO_DIR)
+    try:
         os.mkdir(path)
-    else:
+    except FileExistsError:
         fatalError("Repository in this directory already exists!")
-    os.mknod(normpath(join(path, HEAD)))
-    os.mknod(normpath(join(path, TO_COMMIT)))
+    open(join(path, HEAD), 'w').close()
+    open(join(path, TO_COMMIT), 'w').close()
 
 
 def toCommitList(repoPath):
-    with open(normpath(join(repoPath, REPO_DIR, TO_COMMIT)), 'r') as toCommit:
-        return toCommit.read().splitlines()
+    return readLines(join(repoPath, REPO_DIR, TO_COMMIT))
 
 
 def add(repoPath, files):
     """Stashes given list of files to be commited.
-    Files might be dirs also, then it calls itself recursively
+    Files might be dirs also, then their visible content is added,
+    walking subdirectories iteratively.
     ASSERTION: 'files' paths are relative to 'repoPath'
     """
     dirs = []
-    toCommitAsList = toCommitList(repoPath)
-    toCommit = open(normpath(join(repoPath, REPO_DIR, TO_COMMIT)), 'a+')
+    found = []
     for file in files:
         filePath = normpath(join(repoPath, file))
-        if not exists(filePath):
+        st = statOrNone(filePath)
+        if st is None:
             print("ERROR: " + filePath + " doesn't exist!")
             continue
-        if isdir(filePath):
+        if S_ISDIR(st.st_mode):
             dirs.append(file)
-        elif file not in toCommitAsList:
-            toCommit.write(file + '\n')
-            toCommitAsList.append(file)
-    toCommit.close()
+        else:
+            found.append(file)
     # files from subdirectories handling
-    for dir in dirs:
-        filesInSubdir = os.listdir(normpath(join(repoPath, dir)))
-        add(repoPath, [normpath(join(dir, f)) for f in filesInSubdir])
-
-
-def generateDirTree(repoPath, files):
+    while dirs:
+        dir = dirs.pop()
+        with os.scandir(join(repoPath, dir)) as entries:
+            for entry in entries:
+                # ignore hidden files
+                if entry.name[0] == '.':
+                    continue
+                # 'dir' is normalized, only '.' would leave a './' prefix
+                file = entry.name if dir == '.' else join(dir, entry.name)
+                if entry.is_dir():
+                    dirs.append(file)
+                elif entry.is_symlink() and not entry.is_file():
+                    # dangling symlink
+                    print("ERROR: " + join(repoPath, file) + " doesn't exist!")
+                else:
+                    found.append(file)
+
+    toCommitSet = set(toCommitList(repoPath))
+    newEntries = []
+    for file in found:
+        if file not in toCommitSet:
+            newEntries.append(file)
+            toCommitSet.add(file)
+    # single write of all new entries
+    if newEntries:
+        toCommitPath = join(repoPath, REPO_DIR, TO_COMMIT)
+        with open(toCommitPath, 'a', encoding='utf-8',
+                  errors='surrogateescape') as toCommit:
+            toCommit.write('\n'.join(newEntries) + '\n')
+
+
+def generateDirTree(repoPath, files, prevCommitHash=''):
     """Generates whole directory in HEAD-commit from 'files' list.
+    Files unchanged since 'prevCommitHash' commit are hard-linked
+    to their previous copy instead of being copied again.
     """
-    assert lastCommitHash(repoPath)  # it had to be made earlier
-    dstPath = normpath(join(repoPath, REPO_DIR,
-                            lastCommitHash(repoPath), COMMIT_DIR))
+    # imported here, only commit needs them
+    import filecmp
+    from shutil import copyfile
+
+    commitHash = lastCommitHash(repoPath)
+    assert commitHash  # it had to be made earlier
+    dstPath = join(repoPath, REPO_DIR, commitHash, COMMIT_DIR)
+    # collect every directory on the way to each file, then create them
+    # parents first, with a single mkdir each
+    dirs = set()
     for f in files:
-        srcPath = normpath(join(repoPath, f))
-        newFilePath = normpath(join(dstPath, f))
-        if not os.path.isdir(dirname(newFilePath)):
-            os.makedirs(newFilePath)
-        copy2(srcPath, newFilePath)
+        d = dirname(f)
+        while d and d not in dirs and basename(d) != '..':
+            dirs.add(d)
+            d = dirname(d)
+    for d in sorted(dirs, key=len):
+        os.mkdir(join(dstPath, d))
+    prevPath = None
+    if prevCommitHash:
+        prevPath = join(repoPath, REPO_DIR, prevCommitHash, COMMIT_DIR)
+    # only content matters, so skip copying metadata;
+    # 'files' entries were normalized by add(), plain join is enough
+    for f in files:
+        srcPath = join(repoPath, f)
+        newFilePath = join(dstPath, f)
+        if prevPath:
+            prevFilePath = join(prevPath, f)
+            try:
+                if filecmp.cmp(srcPath, prevFilePath, shallow=False):
+                    os.link(prevFilePath, newFilePath)
+                    continue
+            except OSError:
+                pass  # not in previous commit or links unsupported
+        copyfile(srcPath, newFilePath)
 
 
 def commit(repoPath):
-    newCommitHash = uuid.uuid4().hex
-    newPath = normpath(join(repoPath, REPO_DIR, newCommitHash))
+    from shutil import copyfile
+
+    newCommitHash = os.urandom(16).hex()
+    newPath = join(repoPath, REPO_DIR, newCommitHash)
 
-    toCommit = normpath(join(repoPath, REPO_DIR, TO_COMMIT))
-    commitDir = normpath(join(newPath, COMMIT_DIR))
-    tracked = normpath(join(newPath, TRACKED_LIST))
-    prev = normpath(join(newPath, PREV_COMMIT))
+    toCommit = join(repoPath, REPO_DIR, TO_COMMIT)
+    commitDir = join(newPath, COMMIT_DIR)
+    tracked = join(newPath, TRACKED_LIST)
+    prev = join(newPath, PREV_COMMIT)
 
     assert not os.path.exists(newPath)
 
+    trackedFiles = toCommitList(repoPath)
+
     os.mkdir(newPath)
     os.mkdir(commitDir)
-    os.mknod(tracked)
-    os.mknod(prev)
 
     # set previous commit
     lastCommitName = lastCommitHash(repoPath)  # empty if I'm first commit
-    if lastCommitName:
-        with open(prev, 'w') as prev:
-            prev.write(lastCommitName)
+    with open(prev, 'w') as prev:
+        prev.write(lastCommitName)
 
     # set new HEAD value
-    with open(normpath(join(repoPath, REPO_DIR, HEAD)), 'w') as head:
+    with open(join(repoPath, REPO_DIR, HEAD), 'w') as head:
         head.truncate()
         head.write(newCommitHash)
+    _HEAD_CACHE[repoPath] = newCommitHash
 
     # copy 'toCommit' content to  'TRACKED_LIST' file
-    with open(tracked, 'w') as tracked, open(toCommit, 'r') as toCommit:
-        tracked.writelines(l for l in toCommit)
+    copyfile(toCommit, tracked)
 
     # copy whole directory with tracked files
-    generateDirTree(repoPath, toCommitList(repoPath))
+    generateDirTree(repoPath, trackedFiles, lastCommitName)
 
 
-def wasCommited(repoPath, file):
+def trackedList(repoPath):
+    """Returns list of files tracked by HEAD-commit, empty if none.
+    """
     comm = lastCommitHash(repoPath)
-    tracked = normpath(join(repoPath, REPO_DIR, comm, TRACKED_LIST))
     if not comm:
-        return False
-    with open(tracked) as commited:
-        return file in commited.read().splitlines()
-
-
-def wasAdded(repoPath, file):
-    added = normpath(join(repoPath, REPO_DIR, TO_COMMIT))
-    with open(added) as added:
-        return file in added.read().splitlines()
+        return []
+    tracked = join(repoPath, REPO_DIR, comm, TRACKED_LIST)
+    return readLines(tracked)
+
+
+def cachedStatus(repoPath, key):
+    """Returns output of last 'status' if it's still valid, None otherwise.
+    It's valid if 'key' (HEAD and 'TO_COMMIT' state) is unchanged and no
+    directory seen by that 'status' was modified since, as adding, removing
+    or renaming a file always changes its parent directory mtime.
+    Cache is a plain text file: 'key' line, number of directories line,
+    'mtime_ns<TAB>directory' lines (relative to 'repoPath', so a copied
+    repository doesn't check the original one) and finally the output lines.
+    """
+    try:
+        with open(join(repoPath, REPO_DIR, STATUS_CACHE), encoding='utf-8',
+                  errors='surrogateescape') as cacheFile:
+            lines = cacheFile.read().split('\n')
+        if lines.pop() != '' or lines[0] != key:
+            return None
+        dirsCount = int(lines[1])
+        dirLines = lines[2:2 + dirsCount]
+        if dirsCount < 0 or len(dirLines) != dirsCount:
+            return None
+        for line in dirLines:
+            mtime, d = line.split('\t', 1)
+            st = statOrNone(join(repoPath, d))
+            if st is None or st.st_mtime_ns != int(mtime):
+                return None
+        return lines[2 + dirsCount:]
+    except (OSError, ValueError, IndexError):
+        # missing or malformed cache is just a miss
+        return None
+
+
+def writeStatusCache(repoPath, key, dirMtimes, output, scanStart):
+    """Saves 'status' output for cachedStatus(), unless its validity
+    can't be told by directory mtimes.
+    """
+    mtimes = dirMtimes.values()
+    if None in mtimes or max(mtimes) >= scanStart - STATUS_CACHE_RACY_NS:
+        return
+    # allFiles(repoPath) directories all start with 'repoPath'
+    prefixLen = len(join(repoPath, ''))
+    dirLines = [str(mtime) + '\t' + d[prefixLen:]
+                for d, mtime in dirMtimes.items()]
+    lines = [key, str(len(dirLines))] + dirLines + output
+    if any('\n' in line for line in lines):
+        return  # not representable line by line
+    try:
+        with open(join(repoPath, REPO_DIR, STATUS_CACHE), 'w',
+                  encoding='utf-8', errors='surrogateescape') as cacheFile:
+            cacheFile.write('\n'.join(lines) + '\n')
+    except OSError:
+        pass  # cache is only an optimization
 
 
 def status(repoPath):
-    # need to use relative instead of absolute paths
-    files = changePathsRef('/', repoPath, allFiles(repoPath))
-    for f in files:
-        if not wasCommited(repoPath, f):
-            if not wasAdded(repoPath, f):
-                print(f + " (new file)")
-            else:
-                print(f + " (added and waiting to commit)")
-        else:
+    toCommitStat = os.stat(join(repoPath, REPO_DIR, TO_COMMIT))
+    key = '\t'.join((lastCommitHash(repoPath),
+                     str(toCommitStat.st_mtime_ns),
+                     str(toCommitStat.st_size)))
+    output = cachedStatus(repoPath, key)
+    if output is not None:
+        for line in output:
+            print(line)
+        return
+
+    # read both lists once, not once per file
+    commited = frozenset(trackedList(repoPath))
+    added = set(toCommitList(repoPath))
+    output = []
+    dirMtimes = {}
+    scanStart = time.time_ns()
+    # allFiles() yields 'repoPath' joined with relative paths,
+    # so stripping the prefix gives paths relative to repository
+    prefixLen = len(join(repoPath, ''))
+    for f in allFiles(repoPath, dirMtimes):
+        f = f[prefixLen:]
+        if f in commited:
             # print nothing
-            pass
+            continue
+        if f in added:
+            line = f + " (added and waiting to commit)"
+        else:
+            line = f + " (new file)"
+        print(line)
+        output.append(line)
+
+    writeStatusCache(repoPath, key, dirMtimes, output, scanStart)
 
 
 def help():